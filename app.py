@@ -1,8 +1,7 @@
 import json
 
 from flask import Flask, request, jsonify, url_for, session, redirect, render_template, send_from_directory, \
-    get_flashed_messages, flash
-from keras.src.applications import VGG16
+    get_flashed_messages, flash, current_app
 from werkzeug.utils import secure_filename
 import os
 
@@ -10,28 +9,85 @@ import os
 import database
 import image_processor
 
-app = Flask(__name__)
-app.config['UPLOAD_FOLDER'] = 'static/uploads'
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
-model = None
+def prepare_database():
+    """Create the tables the app relies on and normalise stored image paths"""
+    db_conn = database.connect_db()
+    database.create_table(db_conn)
+    database.create_gallery_table(db_conn)
+    database.create_uploaded_images_table(db_conn)
+    database.update_image_paths()
+    db_conn.close()
+
+
+def create_app(gallery_index=None):
+    """
+    Build the Flask application
+    Args:
+        gallery_index: An index from image_processor.load_gallery_index to serve searches from,
+                       without one every search reads the gallery from the database
+    Returns:
+        The configured Flask app
+    """
+    app = Flask(__name__)
+    app.config['UPLOAD_FOLDER'] = 'static/uploads'
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+
+    app.config['GALLERY_INDEX'] = gallery_index
+
+    app.add_url_rule('/', view_func=index)
+    app.add_url_rule('/home', view_func=home)
+    app.add_url_rule('/ready', view_func=ready)
+    app.add_url_rule('/upload', view_func=upload_image, methods=['POST'])
+    app.add_url_rule('/add_image_to_gallery', view_func=add_image_to_gallery, methods=['POST'])
+    app.add_url_rule('/search_similar', view_func=search_similar, methods=['POST'])
+    app.add_url_rule('/upload_and_search', view_func=upload_and_search, methods=['POST'])
+    app.add_url_rule('/gallery', view_func=gallery)
+    app.add_url_rule('/image_detail/<image_name>', view_func=image_detail)
+    app.add_url_rule('/about', view_func=about)
+    app.add_url_rule('/contact', view_func=contact)
+    return app
+
+
+def gallery_backbone(db_conn):
+    # New gallery images are embedded with the same model as the index they will be searched in,
+    # or without a preloaded index, the model most of the gallery is embedded with
+    gallery_index = current_app.config.get('GALLERY_INDEX')
+    if gallery_index is not None:
+        return gallery_index['backbone']
+    return image_processor.select_gallery_backbone(db_conn)[0]
+
+
+def find_best_matches(query_image_path, db_conn):
+    # Searches the preloaded gallery index when there is one, otherwise reads the database
+    gallery_index = current_app.config.get('GALLERY_INDEX')
+    if gallery_index is not None:
+        return image_processor.find_best_matches_index(query_image_path, gallery_index)
+    return image_processor.find_best_matches_db(query_image_path, db_conn)
 
-@app.before_first_request
-def load_model():
-    global model
-    model = VGG16(weights='imagenet', include_top=False)
 
-@app.route('/')
 def index():
     print("Index page is being rendered")
     return render_template('index.html')
 
-@app.route('/home')
 def home():
     return render_template('add_image.html')
 
 
-@app.route('/upload', methods=['POST'])
+# Reports whether this process has its model and gallery index loaded
+def ready():
+    gallery_index = current_app.config.get('GALLERY_INDEX')
+    if gallery_index is None or not image_processor.is_model_loaded(gallery_index['backbone']):
+        return jsonify({'ready': False}), 503
+    return jsonify({
+        'ready': True,
+        'generation': gallery_index['generation'],
+        'images': len(gallery_index['paths']),
+        'backbone': gallery_index['backbone'],
+        'backbone_version': gallery_index['version']
+    })
+
+
 # Handles file upload, saving, and storing metadata in the database
 def upload_image():
     if 'image' not in request.files:
@@ -42,8 +98,8 @@ def upload_image():
 
     filename = secure_filename(file.filename)
     # Save the image to the 'static/uploads' folder
-    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    file.save(os.path.join(app.root_path, filepath))
+    filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
+    file.save(os.path.join(current_app.root_path, filepath))
 
     # Extract ingredients data from form
     ingredients = request.form.get('ingredients', '')
@@ -59,7 +115,7 @@ def upload_image():
     # URL for accessing the uploaded image, ensuring no 'static' duplication
     file_url = url_for('static', filename=filepath_for_db, _external=True)
 
-    print(f"Filepath for saving: {os.path.join(app.root_path, filepath)}")
+    print(f"Filepath for saving: {os.path.join(current_app.root_path, filepath)}")
     print(f"Filepath for DB: {filepath_for_db}")
     print(f"Generated File URL: {file_url}")
 
@@ -69,7 +125,6 @@ def upload_image():
         'filepath': file_url
     })
 
-@app.route('/add_image_to_gallery', methods=['POST'])
 # Handles adding images to the gallery including saving and feature extraction
 def add_image_to_gallery():
     image = request.files['image']
@@ -79,21 +134,24 @@ def add_image_to_gallery():
         filename = secure_filename(image.filename)
 
         # Correct relative path within the 'static/uploads' directory
-        image_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+        image_path = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
 
         # Save the image to the filesystem
         try:
             image.save(image_path)
             print(f"Image saved to {image_path}")
 
-            # Extract the features from the image
-            feature_vector = image_processor.extract_features(image_path)
-
-            # Insert the data into the database
             with database.connect_db() as db_conn:
+                # Extract the features from the image
+                backbone = gallery_backbone(db_conn)
+                # Stored vectors always come from the float32 model, even when searches run on a quantized one
+                feature_vector = image_processor.extract_features(image_path, backbone, quantized=False)
+
+                # Insert the data into the database
                 features_json = json.dumps(feature_vector.tolist())
 
-                database.insert_gallery_image_with_features(db_conn, filename, ingredients, image_path, features_json)
+                database.insert_gallery_image_with_features(db_conn, filename, ingredients, image_path, features_json,
+                                                            backbone, image_processor.backbone_version(backbone))
 
             return jsonify(success=True, message="Image added to gallery.")
 
@@ -107,13 +165,12 @@ def add_image_to_gallery():
         return jsonify(success=False, message="Image or ingredients missing."), 400
 
 
-@app.route('/search_similar', methods=['POST'])
 # Retrieves and displays images similar to the provided one using database matches
 def search_similar():
     image_filename = request.form['image_path'].split('/')[-1]
     db_conn = database.connect_db()
     try:
-        best_matches_info = image_processor.find_best_matches_db(image_filename, db_conn)
+        best_matches_info = find_best_matches(image_filename, db_conn)
         # Convert each tuple in best_matches_info to a dictionary
         similar_images_info = [
             {
@@ -128,20 +185,19 @@ def search_similar():
     return render_template('results.html', query_image=image_filename, similar_images=similar_images_info)
 
 
-@app.route('/upload_and_search', methods=['POST'])
 # Handles file upload followed by searching for similar images
 def upload_and_search():
     file = request.files['image']
     if file:
         filename = secure_filename(file.filename)
         # Save the file to the UPLOAD_FOLDER
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(os.path.join(app.root_path, filepath))
+        filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
+        file.save(os.path.join(current_app.root_path, filepath))
 
         db_conn = database.connect_db()
         try:
-            full_path = os.path.join(app.root_path, filepath)
-            best_matches_info = image_processor.find_best_matches_db(full_path, db_conn)
+            full_path = os.path.join(current_app.root_path, filepath)
+            best_matches_info = find_best_matches(full_path, db_conn)
             similar_images_info = [
                 {
                     'path': url_for('static', filename='uploads/' + os.path.basename(match[0])).replace('\\', '/'),
@@ -156,7 +212,6 @@ def upload_and_search():
     return jsonify({'success': False, 'message': "No file uploaded."})
 
 
-@app.route('/gallery')
 # Displays all images in the gallery
 def gallery():
     db_conn = database.connect_db()
@@ -180,7 +235,6 @@ def gallery():
     return render_template('gallery.html', gallery_images_info=gallery_images_info)
 
 
-@app.route('/image_detail/<image_name>')
 # Display detailed information about a specific image
 def image_detail(image_name):
     with database.connect_db() as db_conn:
@@ -192,23 +246,18 @@ def image_detail(image_name):
     else:
         return 'Image not found', 404
 
-@app.route('/about')
 def about():
     return render_template('about_us.html')
 
-@app.route('/contact')
 def contact():
     return render_template('contact_us.html')
 
 
 
 # Run the Flask application
+# Development server only, use serve.py for production
 if __name__ == '__main__':
-    db_conn = database.connect_db()
-    database.create_table(db_conn)
-    database.create_gallery_table(db_conn)
-    database.create_uploaded_images_table(db_conn)
-    database.update_image_paths()
-    db_conn.close()
+    prepare_database()
+    app = create_app()
     app.run(debug=True, host='0.0.0.0')
     #app.run(debug=True)
\ No newline at end of file
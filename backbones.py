@@ -0,0 +1,176 @@
+"""
+Compare feature extractor backbones on our own gallery and re-embed the gallery with one
+
+compare embeds a sample of gallery images with each backbone and reports latency, memory and
+retrieval quality side by side. Each backbone runs in a fresh process, so its memory figures do
+not depend on which backbones were loaded before it. Retrieval quality is measured two ways: precision@k, counting a
+neighbour as relevant when it has exactly the same ingredients as the query (the same product),
+and top-k agreement with the first backbone listed.
+
+reembed replaces every stored gallery feature vector with one from the chosen backbone in a
+single transaction. Gallery images that never had a feature vector are left alone, so they do
+not start turning up in searches. A running serve.py picks the new embedding model up on its
+next reload, because the gallery index follows the backbone most of the gallery is embedded with.
+
+Usage:
+    python backbones.py compare --backbones vgg16 mobilenet_v2 efficientnet_b0 --samples 200 --top-k 3
+    python backbones.py --weights mobilenet_v2=weights/mobilenet_v2_notop.h5 reembed --backbone mobilenet_v2
+"""
+import argparse
+import json
+import multiprocessing
+import random
+import resource
+import time
+
+import numpy as np
+
+import database
+import image_processor
+
+
+def peak_rss_mb():
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def embed_image_file(image_file, backbone):
+    processed_img = image_processor.preprocess_image_for_cnn(image_file, backbone=backbone)
+    return image_processor.predict_features(processed_img, backbone, quantized=False).flatten()
+
+
+def embed_sample(backbone, image_files, weights):
+    """Embed the sample with one backbone, returning the vectors and what it cost"""
+    for name, weights_path in weights.items():
+        image_processor.register_backbone_weights(name, weights_path)
+    rss_before = peak_rss_mb()
+    start = time.perf_counter()
+    model = image_processor.load_model(backbone)
+    load_seconds = time.perf_counter() - start
+
+    vectors, latencies = [], []
+    for i, image_file in enumerate(image_files):
+        start = time.perf_counter()
+        vectors.append(embed_image_file(image_file, backbone))
+        # The first call pays for one-off setup
+        if i > 0:
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    return {
+        'vectors': np.array(vectors, dtype=np.float32),
+        'latencies': latencies,
+        'load_seconds': load_seconds,
+        'rss_growth_mb': peak_rss_mb() - rss_before,
+        'weights_mb': model.count_params() * 4 / 1e6
+    }
+
+
+def embed_sample_in_subprocess(backbone, image_files):
+    """Run embed_sample in a fresh process, whose peak memory only reflects this one backbone"""
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(embed_sample, (backbone, image_files, dict(image_processor.backbone_weights)))
+
+
+def nearest_neighbours(vectors, top_k):
+    """Row numbers of each vector's top_k nearest other vectors by Euclidean distance"""
+    squared_norms = np.sum(vectors ** 2, axis=1)
+    distances = squared_norms[:, None] + squared_norms[None, :] - 2 * vectors @ vectors.T
+    np.fill_diagonal(distances, np.inf)
+    return np.argsort(distances, axis=1)[:, :top_k]
+
+
+def precision_at_k(neighbours, ingredients):
+    precisions = []
+    for query, row in enumerate(neighbours):
+        if not ingredients[query]:
+            continue
+        precisions.append(np.mean([ingredients[j] == ingredients[query] for j in row]))
+    return float(np.mean(precisions)) if precisions else float('nan')
+
+
+def compare(backbones, sample, gallery_size, top_k):
+    image_files = [image_file for image_file, _ in sample]
+    ingredients = [img_ingredients for _, img_ingredients in sample]
+    print(f"Comparing {', '.join(backbones)} on {len(sample)} gallery images, top-{top_k}")
+
+    results = {}
+    reference = None
+    for backbone in backbones:
+        result = embed_sample_in_subprocess(backbone, image_files)
+        neighbours = nearest_neighbours(result['vectors'], top_k)
+        if reference is None:
+            reference = neighbours
+        result['precision'] = precision_at_k(neighbours, ingredients)
+        result['agreement'] = float(np.mean([len(set(a) & set(b)) / top_k for a, b in zip(neighbours, reference)]))
+        results[backbone] = result
+
+    header = f"{'backbone':<16}{'dim':>7}{'p50 ms':>9}{'p95 ms':>9}{'load s':>8}{'weights MB':>12}" \
+             f"{'RSS +MB':>9}{'index MB':>10}{'P@k':>7}{'agree':>7}"
+    print(header)
+    print('-' * len(header))
+    for backbone, result in results.items():
+        dimension = result['vectors'].shape[1]
+        latencies = result['latencies'] or [float('nan')]
+        print(f"{backbone:<16}{dimension:>7}{np.percentile(latencies, 50):>9.1f}{np.percentile(latencies, 95):>9.1f}"
+              f"{result['load_seconds']:>8.1f}{result['weights_mb']:>12.1f}{result['rss_growth_mb']:>9.0f}"
+              f"{dimension * 4 * gallery_size / 1e6:>10.1f}{result['precision']:>7.2f}{result['agreement']:>7.2f}")
+    print("RSS +MB is the peak memory growth of a fresh process loading the backbone and embedding the sample")
+    print(f"index MB is the float32 feature matrix for all {gallery_size} gallery images; "
+          f"agree is top-k overlap with {backbones[0]}")
+
+
+def reembed(db_conn, backbone):
+    """Embed every gallery image not yet embedded with this backbone, then store them all at once"""
+    version = image_processor.backbone_version(backbone)
+    rows = database.fetch_gallery_images_not_embedded_with(db_conn, backbone, version)
+    print(f"Re-embedding {len(rows)} gallery images with {backbone} v{version}")
+
+    updates = []
+    for image_id, img_path in rows:
+        image_file = image_processor.resolve_gallery_image_file(img_path)
+        if image_file is None:
+            continue
+        updates.append((image_id, json.dumps(embed_image_file(image_file, backbone).tolist())))
+
+    if len(updates) < len(rows):
+        print(f"{len(rows) - len(updates)} images are missing on disk and keep their old feature vectors")
+    if updates:
+        database.update_gallery_features(db_conn, updates, backbone, version)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare feature extractor backbones and re-embed the gallery")
+    parser.add_argument('--db', default='image_features2.db')
+    parser.add_argument('--weights', action='append', default=[], metavar='NAME=PATH',
+                        type=image_processor.parse_backbone_weights,
+                        help="Load a backbone's weights from a local file, can be repeated")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    compare_parser = subparsers.add_parser('compare', help="Side-by-side latency, memory and retrieval quality")
+    compare_parser.add_argument('--backbones', nargs='+', choices=list(image_processor.BACKBONES),
+                                default=list(image_processor.BACKBONES))
+    compare_parser.add_argument('--samples', type=int, default=200)
+    compare_parser.add_argument('--top-k', type=int, default=3)
+
+    reembed_parser = subparsers.add_parser('reembed', help="Replace the gallery feature vectors using one backbone")
+    reembed_parser.add_argument('--backbone', choices=list(image_processor.BACKBONES), required=True)
+
+    args = parser.parse_args()
+    for name, weights_path in args.weights:
+        image_processor.register_backbone_weights(name, weights_path)
+
+    db_conn = database.connect_db(args.db)
+    try:
+        database.create_gallery_table(db_conn)
+        if args.command == 'compare':
+            gallery = image_processor.gallery_image_files(db_conn, with_ingredients=True)
+            sample = random.Random(0).sample(gallery, min(args.samples, len(gallery)))
+            compare(args.backbones, sample, len(gallery), args.top_k)
+        else:
+            reembed(db_conn, args.backbone)
+    finally:
+        db_conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,17 @@
 # Import the sqlite3 library to work with SQLite databases
 import os
 import sqlite3
+# Import contextlib to build the read_snapshot context manager
+import contextlib
+# Import uuid to give each database its own id
+import uuid
 # Import the json library to serialize/deserialize Python lists to/from JSON
 import json
 
+# Every feature vector stored before gallery rows recorded their embedding model came from VGG16
+LEGACY_BACKBONE = 'vgg16'
+LEGACY_BACKBONE_VERSION = '1'
+
 # Function to connect to an SQLite database
 def connect_db(db_path='image_features2.db'):
     abs_path = os.path.abspath(db_path)
@@ -39,11 +47,220 @@ def create_gallery_table(conn):
                     image_name TEXT,
                     ingredients TEXT,
                     image_path TEXT,  
-                    feature_vector TEXT)''')
+                    feature_vector TEXT,
+                    backbone TEXT,
+                    backbone_version TEXT,
+                    row_generation INTEGER)''')
         conn.commit()
         print("Gallery table created successfully.")
     except Exception as e:
         print(f"An error occurred while creating gallery_table: {e}")
+    add_gallery_columns(conn)
+    create_gallery_generation_tracking(conn)
+
+
+def add_gallery_columns(conn):
+    """
+    Add the columns introduced after gallery_table was first created
+    Columns and their backfill are added in one transaction, so a failed migration leaves no
+    column behind that would make the next startup skip the backfill
+    """
+    c = conn.cursor()
+    c.execute("PRAGMA table_info(gallery_table)")
+    if {'backbone', 'row_generation'} <= {row[1] for row in c.fetchall()}:
+        return
+    try:
+        c.execute("BEGIN IMMEDIATE")
+        # Read the columns again under the write lock, another process may have just added them
+        c.execute("PRAGMA table_info(gallery_table)")
+        columns = [row[1] for row in c.fetchall()]
+        if 'backbone' not in columns:
+            c.execute("ALTER TABLE gallery_table ADD COLUMN backbone TEXT")
+            c.execute("ALTER TABLE gallery_table ADD COLUMN backbone_version TEXT")
+            c.execute("UPDATE gallery_table SET backbone = ?, backbone_version = ? WHERE feature_vector IS NOT NULL",
+                      (LEGACY_BACKBONE, LEGACY_BACKBONE_VERSION))
+            print("Added backbone columns to gallery_table.")
+        if 'row_generation' not in columns:
+            # Rows written before this column existed are left NULL, which sorts before every generation
+            c.execute("ALTER TABLE gallery_table ADD COLUMN row_generation INTEGER")
+            print("Added row_generation column to gallery_table.")
+        conn.commit()
+    except sqlite3.DatabaseError as e:
+        conn.rollback()
+        print(f"An error occurred while adding columns to gallery_table: {e}")
+
+
+def fetch_majority_backbone(conn):
+    """Return the (backbone, version) most gallery feature vectors were embedded with, or None"""
+    c = conn.cursor()
+    c.execute("""
+        SELECT backbone, backbone_version FROM gallery_table
+        WHERE feature_vector IS NOT NULL AND backbone IS NOT NULL
+        GROUP BY backbone, backbone_version
+        ORDER BY COUNT(*) DESC
+        LIMIT 1
+    """)
+    return c.fetchone()
+
+
+def gallery_tracking_triggers():
+    """Return the CREATE TRIGGER statement for each generation tracking trigger, by trigger name"""
+    bump_generation = "UPDATE gallery_meta SET value = value + 1 WHERE key = 'generation';"
+    current_generation = "(SELECT value FROM gallery_meta WHERE key = 'generation')"
+    stamp_row = f"UPDATE gallery_table SET row_generation = {current_generation} WHERE id = NEW.id;"
+    # Setting row_generation must not count as a change itself, so updates only fire on the data columns
+    events = {
+        'insert': ("INSERT", stamp_row),
+        'update': ("UPDATE OF image_name, ingredients, image_path, feature_vector, backbone, backbone_version",
+                   stamp_row),
+        'delete': ("DELETE", f"INSERT INTO gallery_deletions (id, generation) VALUES (OLD.id, {current_generation});")
+    }
+    return {
+        f"gallery_generation_{name}": f"""CREATE TRIGGER gallery_generation_{name}
+                    AFTER {event} ON gallery_table
+                    BEGIN
+                        {bump_generation}
+                        {body}
+                    END"""
+        for name, (event, body) in events.items()
+    }
+
+
+def create_gallery_generation_tracking(conn):
+    """
+    Keep a gallery generation number that is bumped on every change to gallery_table
+    Serving processes poll it to find out when their in-memory gallery index is stale
+    Each row also records the generation it was last written in, and deleted rows are kept in
+    gallery_deletions, so everything that changed since a given generation can be fetched
+    Nothing is written when the tracking is already up to date, so starting up does not need
+    the write lock another process may be holding
+    """
+    c = conn.cursor()
+    c.execute("SELECT name, sql FROM sqlite_master WHERE name IN ('gallery_meta', 'gallery_deletions') "
+              "OR (type = 'trigger' AND tbl_name = 'gallery_table')")
+    schema = dict(c.fetchall())
+    meta_keys = set()
+    if 'gallery_meta' in schema:
+        c.execute("SELECT key FROM gallery_meta")
+        meta_keys = {row[0] for row in c.fetchall()}
+
+    # Triggers catch every writer, including scripts that bypass this module
+    # Ones created by older versions of this module are replaced with the current definitions
+    stale_triggers = {name: sql for name, sql in gallery_tracking_triggers().items() if schema.get(name) != sql}
+    missing_meta = {'generation', 'database_id'} - meta_keys
+    if not stale_triggers and not missing_meta and 'gallery_deletions' in schema:
+        return
+
+    try:
+        c.execute("BEGIN IMMEDIATE")
+        c.execute('''CREATE TABLE IF NOT EXISTS gallery_meta
+                    (key TEXT PRIMARY KEY,
+                    value)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS gallery_deletions
+                    (id INTEGER,
+                    generation INTEGER)''')
+        c.execute("INSERT OR IGNORE INTO gallery_meta (key, value) VALUES ('generation', 0)")
+        # Identifies this database, so a snapshot is never applied to a different one
+        c.execute("INSERT OR IGNORE INTO gallery_meta (key, value) VALUES ('database_id', ?)", (str(uuid.uuid4()),))
+        for name, sql in stale_triggers.items():
+            c.execute(f"DROP TRIGGER IF EXISTS {name}")
+            c.execute(sql)
+        conn.commit()
+    except sqlite3.OperationalError as e:
+        conn.rollback()
+        print(f"An error occurred while setting up gallery generation tracking: {e}")
+
+
+def fetch_database_id(conn):
+    """Return the id identifying this database, or None if it has not been assigned yet"""
+    c = conn.cursor()
+    try:
+        c.execute("SELECT value FROM gallery_meta WHERE key = 'database_id'")
+    except sqlite3.OperationalError:
+        return None
+    row = c.fetchone()
+    return row[0] if row else None
+
+
+def prune_gallery_deletions(conn, through_generation):
+    """
+    Forget deletions made at or before a generation, e.g. the generation of the oldest snapshot still in use
+    Indexes older than that can no longer be brought up to date with fetch_gallery_changes_since
+    and have to be loaded in full instead
+    """
+    try:
+        c = conn.cursor()
+        c.execute("DELETE FROM gallery_deletions WHERE generation <= ?", (through_generation,))
+        pruned = c.rowcount
+        c.execute("""
+            INSERT INTO gallery_meta (key, value) VALUES ('deletions_pruned_through', ?)
+            ON CONFLICT(key) DO UPDATE SET value = MAX(value, excluded.value)
+        """, (through_generation,))
+        conn.commit()
+        print(f"Pruned {pruned} gallery deletions up to generation {through_generation}.")
+    except sqlite3.OperationalError as e:
+        conn.rollback()
+        print(f"An error occurred while pruning gallery deletions: {e}")
+
+
+@contextlib.contextmanager
+def read_snapshot(conn):
+    """Run several reads against one consistent, point-in-time view of the database"""
+    if conn.in_transaction:
+        yield conn
+        return
+    conn.execute("BEGIN")
+    try:
+        yield conn
+    finally:
+        conn.commit()
+
+
+def fetch_gallery_feature_rows(conn, backbone, backbone_version):
+    """Fetch (id, image_path, feature_vector, ingredients) of the gallery rows embedded with one model"""
+    c = conn.cursor()
+    c.execute("""
+        SELECT id, image_path, feature_vector, ingredients FROM gallery_table
+        WHERE feature_vector IS NOT NULL AND backbone = ? AND backbone_version = ?
+    """, (backbone, backbone_version))
+    return c.fetchall()
+
+
+def fetch_gallery_changes_since(conn, generation):
+    """
+    Fetch everything that changed in gallery_table after a given generation
+    Returns:
+        (current generation,
+         changed rows as (id, image_path, feature_vector, ingredients, backbone, backbone_version),
+         ids of deleted rows)
+        or None when deletions after that generation have already been pruned
+    """
+    with read_snapshot(conn):
+        current_generation = fetch_gallery_generation(conn)
+        c = conn.cursor()
+        c.execute("SELECT value FROM gallery_meta WHERE key = 'deletions_pruned_through'")
+        row = c.fetchone()
+        if row and generation < row[0]:
+            return None
+        c.execute("""
+            SELECT id, image_path, feature_vector, ingredients, backbone, backbone_version FROM gallery_table
+            WHERE row_generation > ?
+        """, (generation,))
+        changed_rows = c.fetchall()
+        c.execute("SELECT id FROM gallery_deletions WHERE generation > ?", (generation,))
+        deleted_ids = [row[0] for row in c.fetchall()]
+    return current_generation, changed_rows, deleted_ids
+
+
+def fetch_gallery_generation(conn):
+    """Return the current gallery generation number, or 0 if it is not being tracked yet"""
+    c = conn.cursor()
+    try:
+        c.execute("SELECT value FROM gallery_meta WHERE key = 'generation'")
+    except sqlite3.OperationalError:
+        return 0
+    row = c.fetchone()
+    return row[0] if row else 0
 
 
 def image_already_exists(conn, image_name):
@@ -53,7 +270,8 @@ def image_already_exists(conn, image_name):
     count = c.fetchone()[0]
     return count > 0
 
-def insert_gallery_image_with_features(conn, image_name, ingredients, image_path, features_json):
+def insert_gallery_image_with_features(conn, image_name, ingredients, image_path, features_json,
+                                       backbone=LEGACY_BACKBONE, backbone_version=LEGACY_BACKBONE_VERSION):
     if image_already_exists(conn, image_name):
         print(f"Image {image_name} already exists in the database. Skipping insertion.")
         return
@@ -68,9 +286,9 @@ def insert_gallery_image_with_features(conn, image_name, ingredients, image_path
         c = conn.cursor()
         # Insert data into the gallery_table
         c.execute("""
-            INSERT INTO gallery_table (image_name, ingredients, image_path, feature_vector)
-            VALUES (?, ?, ?, ?)
-        """, (image_name, ingredients_json, image_path, features_json))
+            INSERT INTO gallery_table (image_name, ingredients, image_path, feature_vector, backbone, backbone_version)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (image_name, ingredients_json, image_path, features_json, backbone, backbone_version))
         conn.commit()
         print(f"Successfully inserted {image_name} into gallery_table.")
     except sqlite3.DatabaseError as e:
@@ -121,6 +339,37 @@ def update_image_feature(conn, image_path, feature_vector, category=""):
     # Commit changes to the database
     conn.commit()
 
+def fetch_gallery_images_not_embedded_with(conn, backbone, backbone_version):
+    """
+    Fetch (id, image_path) of gallery images whose feature vector came from a different embedding model
+    Rows without a feature vector (uploads that were never made searchable) are left out
+    """
+    c = conn.cursor()
+    c.execute("""
+        SELECT id, image_path FROM gallery_table
+        WHERE feature_vector IS NOT NULL AND (backbone IS NOT ? OR backbone_version IS NOT ?)
+    """, (backbone, backbone_version))
+    return c.fetchall()
+
+def update_gallery_features(conn, rows, backbone, backbone_version):
+    """
+    Replace the feature vectors of several gallery images in a single transaction
+    Args:
+        conn: Database connection object
+        rows: (id, features_json) pairs
+        backbone: Name of the backbone the new vectors were embedded with
+        backbone_version: Version of that backbone
+    """
+    try:
+        c = conn.cursor()
+        c.executemany("UPDATE gallery_table SET feature_vector = ?, backbone = ?, backbone_version = ? WHERE id = ?",
+                      [(features_json, backbone, backbone_version, image_id) for image_id, features_json in rows])
+        conn.commit()
+        print(f"Updated {len(rows)} gallery feature vectors to {backbone} v{backbone_version}.")
+    except Exception as e:
+        print(f"An error occurred while updating gallery features: {e}")
+        conn.rollback()
+
 def update_image_paths(db_path='image_features2.db'):
     # Connect to the database
     conn = sqlite3.connect(db_path)
@@ -133,8 +382,9 @@ def update_image_paths(db_path='image_features2.db'):
     for img_id, path in images:
         # Remove 'static/' prefix if present and ensure no leading '/'
         new_path = path.replace('static/', '').lstrip('/')
-        # Update the database
-        cursor.execute("UPDATE gallery_table SET image_path=? WHERE id=?", (new_path, img_id))
+        # Only touch rows that actually change so the gallery generation stays put
+        if new_path != path:
+            cursor.execute("UPDATE gallery_table SET image_path=? WHERE id=?", (new_path, img_id))
 
     # Commit the changes and close the connection
     conn.commit()
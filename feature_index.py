@@ -0,0 +1,116 @@
+"""
+In-memory gallery index: the feature vectors of one embedding model as a float32 matrix
+
+An index is a dictionary with 'ids', 'paths', 'ingredients' (one entry per matrix row),
+'features' (the matrix), 'generation' (the gallery generation it reflects), 'backbone' and
+'version'. It only needs NumPy and the database, so snapshot tooling can use it without
+loading TensorFlow.
+"""
+import json
+
+import numpy as np
+
+import database
+
+
+def load_gallery_index(db_conn, backbone, version):
+    """
+    Load the gallery feature vectors of one embedding model into a float32 matrix for in-memory search
+    Rows without features, or whose length differs from the majority, are left out
+    Returns a dictionary with 'ids', 'paths', 'ingredients', 'features', 'generation', 'backbone' and 'version'
+    """
+    # Read the generation and the rows from the same point in time
+    with database.read_snapshot(db_conn):
+        generation = database.fetch_gallery_generation(db_conn)
+        rows = database.fetch_gallery_feature_rows(db_conn, backbone, version)
+
+    stored_images = [(image_id, img_path, json.loads(features_json), img_ingredients)
+                     for image_id, img_path, features_json, img_ingredients in rows]
+    stored_images = [row for row in stored_images if len(row[2]) > 0]
+
+    lengths = [len(features) for _, _, features, _ in stored_images]
+    dimension = max(set(lengths), key=lengths.count) if lengths else 0
+
+    ids, paths, ingredients, vectors = [], [], [], []
+    for image_id, img_path, features, img_ingredients in stored_images:
+        if len(features) != dimension:
+            print(f"Skipping incompatible feature vector for image: {img_path}")
+            continue
+        ids.append(image_id)
+        paths.append(img_path)
+        ingredients.append(img_ingredients)
+        vectors.append(features)
+
+    feature_matrix = np.array(vectors, dtype=np.float32).reshape(len(vectors), dimension)
+    print(f"Loaded {backbone} v{version} gallery index with {len(paths)} images at generation {generation}")
+    return {
+        'ids': ids,
+        'paths': paths,
+        'ingredients': ingredients,
+        'features': feature_matrix,
+        'generation': generation,
+        'backbone': backbone,
+        'version': version
+    }
+
+
+def same_index_rows(gallery_index, other_index):
+    """Check whether two gallery indexes hold the same rows and vectors, whatever generation each is at"""
+    if (gallery_index['backbone'], gallery_index['version']) != (other_index['backbone'], other_index['version']):
+        return False
+    if (gallery_index['ids'], gallery_index['paths'], gallery_index['ingredients']) != \
+            (other_index['ids'], other_index['paths'], other_index['ingredients']):
+        return False
+    return gallery_index['features'] is other_index['features'] or \
+        np.array_equal(gallery_index['features'], other_index['features'])
+
+
+def apply_gallery_changes(gallery_index, db_conn, backbone, version):
+    """
+    Bring a gallery index up to date by applying only the rows written or deleted since its generation
+    backbone and version are the embedding model the index should be using now
+    Falls back to a full load when the index is empty, is for a different embedding model,
+    or the deletions since the index's generation have been pruned
+    Returns the updated index, which is the same object when nothing changed
+    """
+    if gallery_index['features'].shape[0] == 0 or (backbone, version) != (gallery_index['backbone'],
+                                                                         gallery_index['version']):
+        return load_gallery_index(db_conn, backbone, version)
+
+    changes = database.fetch_gallery_changes_since(db_conn, gallery_index['generation'])
+    if changes is None:
+        print(f"Gallery changes since generation {gallery_index['generation']} were pruned, reloading the index")
+        return load_gallery_index(db_conn, backbone, version)
+    generation, changed_rows, deleted_ids = changes
+    if generation == gallery_index['generation']:
+        return gallery_index
+
+    stale_ids = set(deleted_ids) | {row[0] for row in changed_rows}
+    keep = [i for i, image_id in enumerate(gallery_index['ids']) if image_id not in stale_ids]
+    dimension = gallery_index['features'].shape[1]
+
+    ids = [gallery_index['ids'][i] for i in keep]
+    paths = [gallery_index['paths'][i] for i in keep]
+    ingredients = [gallery_index['ingredients'][i] for i in keep]
+    vectors = []
+    for image_id, img_path, features_json, img_ingredients, row_backbone, row_version in changed_rows:
+        if features_json is None or (row_backbone, row_version) != (backbone, version):
+            continue
+        features = json.loads(features_json)
+        if len(features) != dimension:
+            print(f"Skipping incompatible feature vector for image: {img_path}")
+            continue
+        ids.append(image_id)
+        paths.append(img_path)
+        ingredients.append(img_ingredients)
+        vectors.append(features)
+
+    feature_matrix = gallery_index['features']
+    # Leave the matrix alone (it may be memory-mapped) unless rows actually come or go
+    if len(keep) != feature_matrix.shape[0] or vectors:
+        feature_matrix = np.concatenate([feature_matrix[keep],
+                                         np.array(vectors, dtype=np.float32).reshape(len(vectors), dimension)])
+    print(f"Applied {len(changed_rows)} changed and {len(deleted_ids)} deleted gallery rows, "
+          f"generation {gallery_index['generation']} -> {generation}")
+    return dict(gallery_index, ids=ids, paths=paths, ingredients=ingredients,
+                features=feature_matrix, generation=generation)
@@ -1,19 +1,138 @@
 from tensorflow.keras.preprocessing import image  # Import image preprocessing utilities from Keras
-from tensorflow.keras.applications.vgg16 import preprocess_input, VGG16  # Import VGG16 model and preprocessing function
+from tensorflow.keras.applications import vgg16, mobilenet_v2, efficientnet  # Import the supported backbones
 import numpy as np  # Import NumPy for numerical operations
 import cv2 as cv  # Import OpenCV for image processing
 import os  # Import the os module for interacting with the operating system
 import matplotlib.pyplot as plt  # Import matplotlib for plotting
 import database  # Import a custom database module for database operations
+import feature_index  # Import the in-memory gallery index
 import json  # Import JSON for serialization/deserialization
+import queue  # Import queue to hand TFLite interpreters out to request threads
+import threading  # Import threading so concurrent requests build each model only once
+import argparse  # Import argparse to report bad NAME=PATH weights arguments
 from flask import current_app as app
+import tensorflow as tf  # Import TensorFlow to configure its runtime
 
-# Load the pre-trained VGG16 model without its top layer (fully connected layers)
-model = VGG16(weights='imagenet', include_top=False)
+# ImageNet backbones the feature extractor can use, all without their top (fully connected) layers
+# Bump a backbone's 'version' whenever a change (weights, pooling, preprocessing) makes its new
+# feature vectors incomparable with the ones already stored for it
+BACKBONES = {
+    # Unpooled 7x7x512 maps, kept as they are so existing gallery vectors stay valid
+    'vgg16': {'version': '1', 'build': vgg16.VGG16, 'preprocess': vgg16.preprocess_input, 'pooling': None},
+    'mobilenet_v2': {'version': '1', 'build': mobilenet_v2.MobileNetV2,
+                     'preprocess': mobilenet_v2.preprocess_input, 'pooling': 'avg'},
+    'efficientnet_b0': {'version': '1', 'build': efficientnet.EfficientNetB0,
+                        'preprocess': efficientnet.preprocess_input, 'pooling': 'avg'},
+}
 
-def fetch_image_paths_from_db(db_conn):
+# Backbone used when no gallery index decides it, e.g. for the development server
+active_backbone = 'vgg16'
+# Local weights file per backbone, backbones without one use Keras' 'imagenet' weights
+backbone_weights = {}
+# Models loaded so far, by backbone name, each loaded on first use
+models = {}
+models_lock = threading.Lock()
+
+# Inference backend used by extract_features, 'keras' (float32 models) or 'tflite' (quantized model)
+backend = 'keras'
+interpreter_pool = None
+# Backbone the TFLite model was converted from, other backbones still run on Keras
+tflite_backbone = None
+
+
+class InterpreterPool:
+    """
+    A fixed set of TFLite interpreters for one model file
+    An interpreter can only run one inference at a time, so each request thread borrows one
+    """
+
+    def __init__(self, model_path, size, num_threads=None):
+        self.interpreters = queue.Queue()
+        for _ in range(size):
+            interpreter = tf.lite.Interpreter(model_path=model_path, num_threads=num_threads)
+            interpreter.allocate_tensors()
+            self.interpreters.put(interpreter)
+
+    def predict(self, processed_img):
+        interpreter = self.interpreters.get()
+        try:
+            input_details = interpreter.get_input_details()[0]
+            output_details = interpreter.get_output_details()[0]
+            interpreter.set_tensor(input_details['index'], processed_img.astype(input_details['dtype']))
+            interpreter.invoke()
+            return interpreter.get_tensor(output_details['index'])
+        finally:
+            self.interpreters.put(interpreter)
+
+
+def use_tflite_backend(model_path, pool_size=1, num_threads=None, backbone=None):
+    """Switch extract_features to a quantized TFLite model built with quantize.py from the given backbone"""
+    global backend, interpreter_pool, tflite_backbone
+    interpreter_pool = InterpreterPool(model_path, pool_size, num_threads)
+    tflite_backbone = backbone or active_backbone
+    backend = 'tflite'
+
+def is_model_loaded(backbone=None):
+    """
+    Check whether queries can be embedded with the given backbone without loading anything
+    With the TFLite backend this does not cover the float32 model used for gallery inserts,
+    which is loaded by the first insert
+    """
+    backbone = backbone or active_backbone
+    if backend == 'tflite' and backbone == tflite_backbone:
+        return interpreter_pool is not None
+    return backbone in models
+
+def set_backbone(name):
+    """Choose the default backbone"""
+    global active_backbone
+    if name not in BACKBONES:
+        raise ValueError(f"Unknown backbone {name}, expected one of {', '.join(BACKBONES)}")
+    active_backbone = name
+
+def register_backbone_weights(name, weights_path):
+    """Load a backbone's weights from a local file instead of Keras' 'imagenet' weights"""
+    if name not in BACKBONES:
+        raise ValueError(f"Unknown backbone {name}, expected one of {', '.join(BACKBONES)}")
+    backbone_weights[name] = weights_path
+
+def parse_backbone_weights(value):
+    """argparse type for NAME=PATH weights arguments, returns (name, path)"""
+    name, separator, weights_path = value.partition('=')
+    if not separator or not weights_path:
+        raise argparse.ArgumentTypeError(f"expected NAME=PATH, got {value!r}")
+    if name not in BACKBONES:
+        raise argparse.ArgumentTypeError(f"unknown backbone {name!r}, expected one of {', '.join(BACKBONES)}")
+    return name, weights_path
+
+def backbone_version(backbone=None):
+    return BACKBONES[backbone or active_backbone]['version']
+
+def load_model(backbone=None):
+    """Load a backbone's feature extractor once per process and return it"""
+    backbone = backbone or active_backbone
+    if backbone not in models:
+        # Request threads asking for a model at the same time must not each build their own copy
+        with models_lock:
+            if backbone not in models:
+                spec = BACKBONES[backbone]
+                models[backbone] = spec['build'](weights=backbone_weights.get(backbone, 'imagenet'),
+                                                 include_top=False, pooling=spec['pooling'])
+    return models[backbone]
+
+def configure_tensorflow_threads(intra_op_threads, inter_op_threads):
+    """Limit TensorFlow's thread pools, must be called before the model is loaded or run"""
+    tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+
+def fetch_image_paths_from_db(db_conn, backbone=None, version=None):
+    # With a backbone, only rows embedded by that backbone and version are returned
     c = db_conn.cursor()
-    c.execute("SELECT image_path, feature_vector, ingredients FROM gallery_table")
+    if backbone is None:
+        c.execute("SELECT image_path, feature_vector, ingredients FROM gallery_table")
+    else:
+        c.execute("SELECT image_path, feature_vector, ingredients FROM gallery_table "
+                  "WHERE backbone = ? AND backbone_version = ?", (backbone, version))
     rows = c.fetchall()
 
     # Handling None for feature_vector by setting a default
@@ -31,29 +150,56 @@ def fetch_image_paths_from_db(db_conn):
 
     return result
 
-def preprocess_image_for_cnn(image_path, target_size=(224, 224)):
-    img = image.load_img(image_path, target_size=target_size)  # Load and resize image for VGG16
+def resolve_gallery_image_file(img_path):
+    """Find a gallery image on disk, stored paths may or may not include 'static/'"""
+    for candidate in (img_path, os.path.join('static', img_path)):
+        if os.path.isfile(candidate):
+            return candidate
+    print(f"Gallery image not found on disk: {img_path}")
+    return None
+
+def gallery_image_files(db_conn, with_ingredients=False):
+    """Return the gallery image files that exist on disk, optionally as (file, ingredients) pairs"""
+    files = []
+    for img_path, _, ingredients in fetch_image_paths_from_db(db_conn):
+        image_file = resolve_gallery_image_file(img_path)
+        if image_file is not None:
+            files.append((image_file, ingredients) if with_ingredients else image_file)
+    return files
+
+def preprocess_image_for_cnn(image_path, target_size=(224, 224), backbone=None):
+    img = image.load_img(image_path, target_size=target_size)  # Load and resize image for the backbone
     img_array = image.img_to_array(img)  # Convert the image to a NumPy array
     img_array_expanded = np.expand_dims(img_array, axis=0)  # Add an extra dimension for batch size
-    return preprocess_input(img_array_expanded)  # Preprocess the image array
+    return BACKBONES[backbone or active_backbone]['preprocess'](img_array_expanded)  # Preprocess the image array
 
 
-def extract_features(image_path):
+def extract_features(image_path, backbone=None, quantized=True):
+    # Vectors stored in the gallery must come from the float32 model, so callers storing them pass quantized=False
 
     full_path = os.path.join(app.root_path, image_path)
 
-    processed_img = preprocess_image_for_cnn(full_path)  # Preprocess the image
-    features = model.predict(processed_img)  # Predict the features using VGG16
+    processed_img = preprocess_image_for_cnn(full_path, backbone=backbone)  # Preprocess the image
+    features = predict_features(processed_img, backbone, quantized)  # Predict the features with the backbone
     flattened_features = features.flatten()  # Flatten the features to a 1D array
     return flattened_features  # Return the flattened features
 
 
+def predict_features(processed_img, backbone=None, quantized=True):
+    backbone = backbone or active_backbone
+    if quantized and backend == 'tflite' and backbone == tflite_backbone:
+        return interpreter_pool.predict(processed_img)
+    return load_model(backbone).predict(processed_img)
+
+
 def compare_features(feature1, feature2):
     return np.linalg.norm(feature1 - feature2)  # Calculate and return the Euclidean distance between two feature vectors
 
 def find_best_matches_db(query_image_path, db_conn, num_matches=3):
-    query_features = extract_features(query_image_path)
-    stored_images = fetch_image_paths_from_db(db_conn)
+    # Embed the query with the model the gallery uses; only vectors from that model are comparable with it
+    backbone, version = select_gallery_backbone(db_conn)
+    query_features = extract_features(query_image_path, backbone)
+    stored_images = fetch_image_paths_from_db(db_conn, backbone, version)
 
     matches_info = []
 
@@ -76,6 +222,47 @@ def find_best_matches_db(query_image_path, db_conn, num_matches=3):
 
     return sorted_matches
 
+def select_gallery_backbone(db_conn):
+    """Return the backbone and version most of the gallery is embedded with, if this process supports it"""
+    backbone, version = database.fetch_majority_backbone(db_conn) or (active_backbone, backbone_version())
+    if backbone not in BACKBONES or version != backbone_version(backbone):
+        print(f"Gallery is embedded with unsupported model {backbone} v{version}, using {active_backbone}")
+        backbone, version = active_backbone, backbone_version()
+    return backbone, version
+
+def load_gallery_index(db_conn, backbone=None):
+    """
+    Load the gallery feature vectors of one embedding model for in-memory search, see feature_index
+    Without a backbone, the backbone and version most of the gallery is embedded with is used,
+    so a re-embedded gallery is picked up on the next reload
+    """
+    with database.read_snapshot(db_conn):
+        if backbone is None:
+            backbone, version = select_gallery_backbone(db_conn)
+        else:
+            version = backbone_version(backbone)
+        return feature_index.load_gallery_index(db_conn, backbone, version)
+
+def apply_gallery_changes(gallery_index, db_conn):
+    """Bring a gallery index up to date with the database, following the backbone the gallery is embedded with"""
+    backbone, version = select_gallery_backbone(db_conn)
+    return feature_index.apply_gallery_changes(gallery_index, db_conn, backbone, version)
+
+def find_best_matches_index(query_image_path, gallery_index, num_matches=3):
+    """Same result shape as find_best_matches_db, but searched against a preloaded gallery index"""
+    query_features = extract_features(query_image_path, gallery_index['backbone'])
+    best, distances = rank_gallery(query_features, gallery_index, num_matches)
+    return [(gallery_index['paths'][i], float(distances[i]), gallery_index['ingredients'][i]) for i in best]
+
+def rank_gallery(query_features, gallery_index, num_matches=3):
+    """Return the row numbers of the closest gallery images, nearest first, and all distances"""
+    feature_matrix = gallery_index['features']
+    if feature_matrix.shape[0] == 0 or query_features.shape[0] != feature_matrix.shape[1]:
+        return np.array([], dtype=int), np.array([], dtype=np.float32)
+
+    distances = np.linalg.norm(feature_matrix - query_features.astype(np.float32), axis=1)
+    return np.argsort(distances)[:num_matches], distances
+
 def show_images_with_ingredients(query_image_path, matches_info):
     plt.figure(figsize=(12, 8))
 
@@ -0,0 +1,160 @@
+"""
+Build and check a quantized TFLite version of a feature extractor backbone (VGG16 by default)
+
+Conversion runs entirely on the local machine. Validation compares the quantized model
+against the float32 Keras model on images from our own gallery, so run it before
+switching production to the TFLite backend (serve.py --backend tflite).
+
+Usage:
+    python quantize.py convert --mode float16 --output vgg16_float16.tflite
+    python quantize.py convert --mode int8 --output vgg16_int8.tflite --samples 200
+    python quantize.py validate --tflite-model vgg16_int8.tflite --samples 50 --top-k 3
+"""
+import argparse
+import random
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import database
+import image_processor
+
+# Size the backbone input is fixed to, TFLite needs a static input shape
+INPUT_SHAPE = (1, 224, 224, 3)
+
+
+def sample_gallery_images(db_conn, samples, seed=0):
+    files = image_processor.gallery_image_files(db_conn)
+    random.Random(seed).shuffle(files)
+    return files[:samples]
+
+
+def convert(mode, output_path, calibration_images):
+    """
+    Convert the active backbone's Keras model to TFLite
+    Args:
+        mode: 'float16' stores float16 weights, 'dynamic' stores int8 weights and quantizes
+              activations at run time, 'int8' also quantizes activations using ranges
+              calibrated on calibration_images
+        output_path: Where to write the .tflite file
+        calibration_images: Gallery image files used as the representative dataset for 'int8'
+    """
+    model = image_processor.load_model()
+    concrete_function = tf.function(lambda x: model(x, training=False)).get_concrete_function(
+        tf.TensorSpec(INPUT_SHAPE, tf.float32))
+    converter = tf.lite.TFLiteConverter.from_concrete_functions([concrete_function], model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+
+    if mode == 'float16':
+        converter.target_spec.supported_types = [tf.float16]
+    elif mode == 'int8':
+        if not calibration_images:
+            raise ValueError("int8 quantization needs at least one gallery image for calibration")
+
+        def representative_dataset():
+            for image_file in calibration_images:
+                yield [image_processor.preprocess_image_for_cnn(image_file).astype(np.float32)]
+
+        converter.representative_dataset = representative_dataset
+        print(f"Calibrating on {len(calibration_images)} gallery images")
+
+    tflite_model = converter.convert()
+    with open(output_path, 'wb') as f:
+        f.write(tflite_model)
+    print(f"Wrote {mode} model to {output_path} ({len(tflite_model) / 1e6:.1f} MB)")
+
+
+def timed(predict, processed_img):
+    start = time.perf_counter()
+    features = predict(processed_img)
+    return features.flatten(), (time.perf_counter() - start) * 1000
+
+
+def latency_summary(latencies):
+    return f"mean {np.mean(latencies):.1f} ms, p50 {np.percentile(latencies, 50):.1f} ms, " \
+           f"p95 {np.percentile(latencies, 95):.1f} ms"
+
+
+def validate(tflite_model_path, query_images, gallery_index, top_k, num_threads=None):
+    """
+    Embed each query image with both models and search the stored (float32) gallery with each
+    Reports latency for both models and how often the quantized model returns the same top-k
+    """
+    keras_model = image_processor.load_model()
+    pool = image_processor.InterpreterPool(tflite_model_path, 1, num_threads)
+    image_paths = gallery_index['paths']
+
+    keras_latencies, tflite_latencies = [], []
+    overlaps, top1_matches, cosines = [], [], []
+    for i, image_file in enumerate(query_images):
+        processed_img = image_processor.preprocess_image_for_cnn(image_file)
+        keras_features, keras_ms = timed(keras_model.predict, processed_img)
+        tflite_features, tflite_ms = timed(pool.predict, processed_img)
+        # The first call of each model pays for one-off setup
+        if i > 0:
+            keras_latencies.append(keras_ms)
+            tflite_latencies.append(tflite_ms)
+
+        cosines.append(float(np.dot(keras_features, tflite_features) /
+                             (np.linalg.norm(keras_features) * np.linalg.norm(tflite_features) + 1e-12)))
+
+        # Leave the query itself out, it would trivially be the best match for both models
+        keras_best = [j for j in image_processor.rank_gallery(keras_features, gallery_index, top_k + 1)[0]
+                      if not image_file.endswith(image_paths[j])][:top_k]
+        tflite_best = [j for j in image_processor.rank_gallery(tflite_features, gallery_index, top_k + 1)[0]
+                       if not image_file.endswith(image_paths[j])][:top_k]
+        if keras_best:
+            overlaps.append(len(set(keras_best) & set(tflite_best)) / len(keras_best))
+            top1_matches.append(bool(tflite_best) and keras_best[0] == tflite_best[0])
+
+    print(f"Validated on {len(query_images)} gallery images against {len(image_paths)} stored vectors")
+    if keras_latencies:
+        print(f"float32 Keras latency: {latency_summary(keras_latencies)}")
+        print(f"TFLite latency:        {latency_summary(tflite_latencies)}")
+        print(f"Speedup: {np.mean(keras_latencies) / np.mean(tflite_latencies):.2f}x")
+    if overlaps:
+        print(f"Top-{top_k} agreement: {np.mean(overlaps) * 100:.1f}%")
+        print(f"Top-1 agreement: {np.mean(top1_matches) * 100:.1f}%")
+    if cosines:
+        print(f"Feature cosine similarity: mean {np.mean(cosines):.4f}, min {np.min(cosines):.4f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quantize a feature extractor backbone to TFLite and validate it")
+    parser.add_argument('--db', default='image_features2.db')
+    parser.add_argument('--backbone', choices=list(image_processor.BACKBONES), default='vgg16')
+    parser.add_argument('--weights', help="Local weights file for the backbone")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    convert_parser = subparsers.add_parser('convert', help="Convert the Keras model to a quantized TFLite model")
+    convert_parser.add_argument('--mode', choices=['float16', 'dynamic', 'int8'], default='float16')
+    convert_parser.add_argument('--output', required=True)
+    convert_parser.add_argument('--samples', type=int, default=100,
+                                help="Gallery images to calibrate int8 activations on")
+
+    validate_parser = subparsers.add_parser('validate', help="Compare a TFLite model with the float32 model")
+    validate_parser.add_argument('--tflite-model', required=True)
+    validate_parser.add_argument('--samples', type=int, default=50, help="Gallery images to query with")
+    validate_parser.add_argument('--top-k', type=int, default=3)
+    validate_parser.add_argument('--threads', type=int, default=None, help="TFLite interpreter threads")
+
+    args = parser.parse_args()
+    if args.weights:
+        image_processor.register_backbone_weights(args.backbone, args.weights)
+    image_processor.set_backbone(args.backbone)
+    db_conn = database.connect_db(args.db)
+    try:
+        if args.command == 'convert':
+            calibration_images = sample_gallery_images(db_conn, args.samples) if args.mode == 'int8' else []
+            convert(args.mode, args.output, calibration_images)
+        else:
+            gallery_index = image_processor.load_gallery_index(db_conn, args.backbone)
+            query_images = sample_gallery_images(db_conn, args.samples)
+            validate(args.tflite_model, query_images, gallery_index, args.top_k, args.threads)
+    finally:
+        db_conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,317 @@
+"""
+Production entry point for the Food Brand Matcher
+
+The parent process loads the gallery index once, binds the listening socket and then forks
+worker processes, so the feature matrix is shared copy-on-write instead of being loaded again
+by every worker. The parent never runs TensorFlow: a runtime whose thread pools were started
+before fork() can hang in the child, so each worker builds its own model after forking
+(the weights files themselves are shared through the OS page cache).
+When the gallery generation in the database changes the parent applies the changed rows to
+the index (SIGHUP forces a full reload instead) and, if the index actually changed, forks a
+fresh set of workers and gracefully retires the old ones. A new node can start from a snapshot made with snapshot.py instead of
+reading every feature vector from the database.
+
+Usage:
+    python serve.py --workers 4 --threads 4 --intra-op-threads 2 --inter-op-threads 1
+    python serve.py --snapshot snapshots/gallery-latest
+"""
+import argparse
+import gc
+import os
+import signal
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+import app as food_app
+import database
+import feature_index
+import image_processor
+import snapshot
+
+
+# A worker that exits sooner than this many seconds after starting counts as failing at startup
+MIN_WORKER_LIFETIME = 30
+# Stop the server after this many workers in a row fail at startup, e.g. with a bad model file
+MAX_STARTUP_CRASHES = 5
+# Seconds a client may take to send its request before its connection is dropped
+REQUEST_TIMEOUT = 30
+
+
+class OneRequestHandler(WSGIRequestHandler):
+    """
+    Handles a single request per connection
+    Werkzeug switches threaded servers to HTTP/1.1 keep-alive, where idle browser connections
+    would hold on to the pool's threads and keep retiring workers from exiting
+    """
+
+    protocol_version = 'HTTP/1.0'
+    timeout = REQUEST_TIMEOUT
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """Werkzeug server that handles requests on a fixed-size thread pool"""
+
+    multithread = True
+
+    def __init__(self, host, port, app, threads, fd):
+        super().__init__(host, port, app, handler=OneRequestHandler, fd=fd)
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+        self.free_threads = threading.BoundedSemaphore(threads)
+
+    def get_request(self):
+        # Only accept a connection once a thread is free to handle it, until then it stays
+        # in the listen backlog where an idle worker can take it
+        # The wait is short so serve_forever still notices shutdown()
+        if not self.free_threads.acquire(timeout=0.5):
+            raise OSError("every request thread is busy")
+        try:
+            return super().get_request()
+        except OSError:
+            self.free_threads.release()
+            raise
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.free_threads.release()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Serve the Food Brand Matcher with preloaded, forked workers")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help="Number of worker processes to fork")
+    parser.add_argument('--threads', type=int, default=4,
+                        help="Request handling threads per worker")
+    parser.add_argument('--intra-op-threads', type=int, default=1,
+                        help="TensorFlow threads used inside a single op, per worker")
+    parser.add_argument('--inter-op-threads', type=int, default=1,
+                        help="TensorFlow ops run in parallel, per worker")
+    parser.add_argument('--reload-interval', type=float, default=5.0,
+                        help="Seconds between checks of the gallery generation")
+    parser.add_argument('--backbone', choices=list(image_processor.BACKBONES), default='vgg16',
+                        help="Backbone for an empty gallery and the one --tflite-model was converted from; "
+                             "otherwise the backbone the gallery is embedded with is used")
+    parser.add_argument('--backbone-weights', action='append', default=[], metavar='NAME=PATH',
+                        type=image_processor.parse_backbone_weights,
+                        help="Load a backbone's weights from a local file, can be repeated")
+    parser.add_argument('--backend', choices=['keras', 'tflite'], default='keras',
+                        help="Feature extractor: float32 Keras models or a quantized model from quantize.py")
+    parser.add_argument('--tflite-model', default='vgg16_float16.tflite',
+                        help="TFLite model file used with --backend tflite")
+    parser.add_argument('--snapshot', help="Start from a gallery snapshot directory written by snapshot.py export")
+    parser.add_argument('--skip-snapshot-verify', action='store_true',
+                        help="Do not check the snapshot's checksums, for snapshots already verified on this node")
+    return parser.parse_args()
+
+
+def run_worker(listen_socket, flask_app, args):
+    """Serve requests in a forked worker until SIGTERM, then finish in-flight requests and exit"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    # The parent's SIGTERM handler only flags the parent's own state, so until the server exists
+    # SIGTERM simply ends the worker, e.g. one retired while it is still building its model
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGTERM})
+
+    # Thread limits only take effect if they are set before TensorFlow runs anything in this process
+    image_processor.configure_tensorflow_threads(args.intra_op_threads, args.inter_op_threads)
+
+    backbone = flask_app.config['GALLERY_INDEX']['backbone']
+    if args.backend == 'tflite':
+        # One interpreter per request thread, created after the fork so no worker shares interpreter state
+        image_processor.use_tflite_backend(args.tflite_model, args.threads, args.intra_op_threads, args.backbone)
+    if not image_processor.is_model_loaded(backbone):
+        image_processor.load_model(backbone)
+
+    server = PooledWSGIServer(args.host, args.port, flask_app, args.threads, listen_socket.fileno())
+
+    # shutdown() waits for serve_forever to return, so it cannot run inside the signal handler itself
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+
+    print(f"Worker {os.getpid()} serving {backbone} gallery generation {flask_app.config['GALLERY_INDEX']['generation']}")
+    server.serve_forever()
+    server.pool.shutdown(wait=True)
+    print(f"Worker {os.getpid()} stopped")
+
+
+def spawn_worker(listen_socket, flask_app, args):
+    # Hold SIGTERM back across the fork, run_worker resets the handler before letting it through
+    signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGTERM})
+    pid = os.fork()
+    if pid == 0:
+        exit_code = 0
+        try:
+            run_worker(listen_socket, flask_app, args)
+        except Exception as e:
+            print(f"Worker {os.getpid()} crashed: {e}")
+            exit_code = 1
+        finally:
+            os._exit(exit_code)
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGTERM})
+    return pid
+
+
+def warn_if_tflite_unused(args, gallery_index):
+    """The TFLite model only serves the backbone it was converted from, anything else runs on Keras"""
+    if args.backend == 'tflite' and gallery_index['backbone'] != args.backbone:
+        print(f"Warning: {args.tflite_model} was converted from {args.backbone} but the gallery is embedded with "
+              f"{gallery_index['backbone']}, so queries run on the float32 {gallery_index['backbone']} model. "
+              f"Convert a {gallery_index['backbone']} model and pass --backbone {gallery_index['backbone']}")
+
+
+def build_app(gallery_index):
+    """Wrap a gallery index in a fresh Flask app, ready to be shared with forked workers"""
+    flask_app = food_app.create_app(gallery_index=gallery_index)
+    # Move everything loaded so far out of the garbage collector's reach, so collections in
+    # the workers do not write to (and therefore copy) the pages shared with the parent
+    gc.collect()
+    gc.freeze()
+    return flask_app
+
+
+def main():
+    args = parse_args()
+
+    for name, weights_path in args.backbone_weights:
+        image_processor.register_backbone_weights(name, weights_path)
+    image_processor.set_backbone(args.backbone)
+
+    food_app.prepare_database()
+    if args.backend == 'tflite' and not os.path.isfile(args.tflite_model):
+        raise SystemExit(f"TFLite model not found: {args.tflite_model}, build it with quantize.py convert")
+
+    db_conn = database.connect_db()
+    if args.snapshot:
+        backbone, version = image_processor.select_gallery_backbone(db_conn)
+        gallery_index = snapshot.import_snapshot(args.snapshot, db_conn, backbone, version,
+                                                 not args.skip_snapshot_verify)
+    else:
+        gallery_index = image_processor.load_gallery_index(db_conn)
+    warn_if_tflite_unused(args, gallery_index)
+    flask_app = build_app(gallery_index)
+    generation = flask_app.config['GALLERY_INDEX']['generation']
+
+    listen_socket = socket.create_server((args.host, args.port), backlog=128)
+    # Every worker waits on the same socket; non-blocking accept lets the losers go back to waiting
+    listen_socket.setblocking(False)
+
+    state = {'reload': False, 'stop': False}
+    signal.signal(signal.SIGHUP, lambda signum, frame: state.update(reload=True))
+    signal.signal(signal.SIGTERM, lambda signum, frame: state.update(stop=True))
+    signal.signal(signal.SIGINT, lambda signum, frame: state.update(stop=True))
+
+    # Live workers and retiring ones, by pid, with the time each was started
+    workers = {spawn_worker(listen_socket, flask_app, args): time.monotonic() for _ in range(args.workers)}
+    retiring = set()
+    startup_crashes = 0
+    pending_respawns = 0
+    next_respawn_at = 0
+    next_generation_check = time.monotonic() + args.reload_interval
+    gave_up = False
+    print(f"Serving on {args.host}:{args.port} with {args.workers} workers x {args.threads} threads")
+
+    while not state['stop']:
+        time.sleep(1)
+        now = time.monotonic()
+
+        # Reap exited workers and schedule replacements for any that were not asked to stop
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            retiring.discard(pid)
+            if pid not in workers:
+                continue
+            started = workers.pop(pid)
+            if state['stop']:
+                continue
+            startup_crashes = startup_crashes + 1 if now - started < MIN_WORKER_LIFETIME else 0
+            if startup_crashes >= MAX_STARTUP_CRASHES:
+                print(f"{startup_crashes} workers in a row failed at startup, giving up")
+                state['stop'] = True
+                gave_up = True
+                break
+            # Back off exponentially while workers keep failing at startup
+            delay = min(2 ** startup_crashes, 60)
+            print(f"Worker {pid} exited unexpectedly with status {status}, restarting it in {delay}s")
+            pending_respawns += 1
+            next_respawn_at = now + delay
+
+        if state['stop']:
+            break
+        if pending_respawns and now >= next_respawn_at:
+            for _ in range(pending_respawns):
+                workers[spawn_worker(listen_socket, flask_app, args)] = time.monotonic()
+            pending_respawns = 0
+
+        if now < next_generation_check and not state['reload']:
+            continue
+        next_generation_check = now + args.reload_interval
+        current_generation = database.fetch_gallery_generation(db_conn)
+        if state['reload'] or current_generation != generation:
+            current_index = flask_app.config['GALLERY_INDEX']
+            forced = state['reload']
+            state['reload'] = False
+            if forced:
+                gallery_index = image_processor.load_gallery_index(db_conn)
+            else:
+                gallery_index = image_processor.apply_gallery_changes(current_index, db_conn)
+
+            # Uploads without features and rows embedded with another backbone bump the generation
+            # without changing what is searched, so the running workers can stay
+            if not forced and feature_index.same_index_rows(gallery_index, current_index):
+                print(f"Gallery generation {generation} -> {gallery_index['generation']} "
+                      f"leaves the index unchanged, keeping the workers")
+                flask_app.config['GALLERY_INDEX'] = gallery_index
+                generation = gallery_index['generation']
+                continue
+
+            print(f"Gallery changed (generation {generation} -> {gallery_index['generation']}), reloading workers")
+            warn_if_tflite_unused(args, gallery_index)
+            gc.unfreeze()
+            flask_app = build_app(gallery_index)
+            generation = flask_app.config['GALLERY_INDEX']['generation']
+
+            # Start the new workers before retiring the old ones so the socket is never unattended
+            old_workers = set(workers)
+            workers = {spawn_worker(listen_socket, flask_app, args): time.monotonic() for _ in range(args.workers)}
+            pending_respawns = 0
+            for pid in old_workers:
+                os.kill(pid, signal.SIGTERM)
+            retiring |= old_workers
+
+    print("Shutting down workers")
+    for pid in set(workers) | retiring:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    for pid in set(workers) | retiring:
+        try:
+            os.waitpid(pid, 0)
+        except ChildProcessError:
+            pass
+    db_conn.close()
+    listen_socket.close()
+    if gave_up:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
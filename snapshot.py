@@ -0,0 +1,207 @@
+"""
+Export and import point-in-time snapshots of the gallery index for fast node bootstrap
+
+A snapshot is a directory holding:
+    features.npy    float32 feature matrix, one row per gallery image
+    metadata.jsonl  one line per matrix row with the image id, path and ingredients
+    manifest.json   source database id, gallery generation, embedding model, row count and a sha256 per file
+
+Importing memory-maps the feature matrix instead of JSON-decoding every stored vector, then
+applies only the gallery rows written or deleted since the snapshot's generation.
+
+Deleted gallery rows are remembered in the database so snapshots can catch up on them. Once old
+snapshots are no longer needed, prune that history up to the oldest snapshot still in use.
+
+Usage:
+    python snapshot.py export snapshots/gallery-latest
+    python snapshot.py import snapshots/gallery-latest
+    python snapshot.py prune snapshots/gallery-latest snapshots/gallery-previous
+    python serve.py --snapshot snapshots/gallery-latest
+"""
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+import database
+import feature_index
+
+FORMAT_VERSION = 1
+FEATURES_FILE = 'features.npy'
+METADATA_FILE = 'metadata.jsonl'
+MANIFEST_FILE = 'manifest.json'
+
+
+def file_checksum(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def export_snapshot(db_conn, output_dir, backbone, version):
+    """
+    Write the gallery index of one embedding model as it is at one generation to output_dir
+    The files are written to a '.partial' directory first and renamed into place at the end,
+    so a snapshot directory is always complete
+    Returns the manifest
+    """
+    # A trailing slash would otherwise put the partial directory inside output_dir
+    output_dir = os.path.normpath(output_dir)
+    if os.path.exists(output_dir):
+        raise FileExistsError(f"Snapshot directory already exists: {output_dir}")
+
+    with database.read_snapshot(db_conn):
+        database_id = database.fetch_database_id(db_conn)
+        gallery_index = feature_index.load_gallery_index(db_conn, backbone, version)
+
+    partial_dir = output_dir + '.partial'
+    shutil.rmtree(partial_dir, ignore_errors=True)
+    os.makedirs(partial_dir)
+    try:
+        np.save(os.path.join(partial_dir, FEATURES_FILE), np.ascontiguousarray(gallery_index['features']))
+        with open(os.path.join(partial_dir, METADATA_FILE), 'w', encoding='utf-8') as f:
+            for image_id, img_path, img_ingredients in zip(gallery_index['ids'], gallery_index['paths'],
+                                                            gallery_index['ingredients']):
+                f.write(json.dumps({'id': image_id, 'path': img_path, 'ingredients': img_ingredients}) + '\n')
+
+        manifest = {
+            'format_version': FORMAT_VERSION,
+            'created_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'database_id': database_id,
+            'generation': gallery_index['generation'],
+            'backbone': gallery_index['backbone'],
+            'backbone_version': gallery_index['version'],
+            'rows': gallery_index['features'].shape[0],
+            'dimension': gallery_index['features'].shape[1],
+            'files': {}
+        }
+        for name in (FEATURES_FILE, METADATA_FILE):
+            path = os.path.join(partial_dir, name)
+            manifest['files'][name] = {'sha256': file_checksum(path), 'bytes': os.path.getsize(path)}
+        with open(os.path.join(partial_dir, MANIFEST_FILE), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2)
+
+        os.rename(partial_dir, output_dir)
+    except BaseException:
+        shutil.rmtree(partial_dir, ignore_errors=True)
+        raise
+
+    print(f"Exported {manifest['rows']} {manifest['backbone']} vectors at generation {manifest['generation']} "
+          f"to {output_dir}")
+    return manifest
+
+
+def read_manifest(snapshot_dir):
+    with open(os.path.join(snapshot_dir, MANIFEST_FILE), encoding='utf-8') as f:
+        manifest = json.load(f)
+    if manifest.get('format_version') != FORMAT_VERSION:
+        raise ValueError(f"Unsupported snapshot format {manifest.get('format_version')} in {snapshot_dir}")
+    return manifest
+
+
+def load_snapshot(snapshot_dir, verify=True):
+    """
+    Load a snapshot's manifest and gallery index, with the feature matrix memory-mapped read-only
+    Raises ValueError if the snapshot is incomplete, from an unknown format or fails its checksums
+    """
+    manifest = read_manifest(snapshot_dir)
+
+    for name, expected in manifest['files'].items():
+        path = os.path.join(snapshot_dir, name)
+        if os.path.getsize(path) != expected['bytes']:
+            raise ValueError(f"Snapshot file {path} has the wrong size")
+        if verify and file_checksum(path) != expected['sha256']:
+            raise ValueError(f"Snapshot file {path} does not match its checksum")
+
+    feature_matrix = np.load(os.path.join(snapshot_dir, FEATURES_FILE), mmap_mode='r')
+    ids, paths, ingredients = [], [], []
+    with open(os.path.join(snapshot_dir, METADATA_FILE), encoding='utf-8') as f:
+        for line in f:
+            row = json.loads(line)
+            ids.append(row['id'])
+            paths.append(row['path'])
+            ingredients.append(row['ingredients'])
+
+    if feature_matrix.shape != (manifest['rows'], manifest['dimension']) or len(ids) != manifest['rows']:
+        raise ValueError(f"Snapshot in {snapshot_dir} does not match its manifest")
+
+    return manifest, {
+        'ids': ids,
+        'paths': paths,
+        'ingredients': ingredients,
+        'features': feature_matrix,
+        'generation': manifest['generation'],
+        'backbone': manifest['backbone'],
+        'version': manifest['backbone_version']
+    }
+
+
+def import_snapshot(snapshot_dir, db_conn, backbone, version, verify=True):
+    """
+    Load a snapshot and bring it up to date with the database, returning the gallery index
+    backbone and version are the embedding model the index should be using now
+    Raises ValueError if the snapshot was exported from a different database
+    """
+    manifest, gallery_index = load_snapshot(snapshot_dir, verify)
+    database_id = database.fetch_database_id(db_conn)
+    if manifest.get('database_id') is None or manifest['database_id'] != database_id:
+        raise ValueError(f"Snapshot {snapshot_dir} was exported from database {manifest.get('database_id')}, "
+                         f"not from this one ({database_id})")
+    print(f"Loaded snapshot of {len(gallery_index['ids'])} images at generation {gallery_index['generation']}")
+
+    # A database behind the snapshot cannot say what changed, e.g. it was restored from an older backup
+    if database.fetch_gallery_generation(db_conn) < gallery_index['generation']:
+        print("Database is older than the snapshot, loading the gallery index from the database instead")
+        return feature_index.load_gallery_index(db_conn, backbone, version)
+    return feature_index.apply_gallery_changes(gallery_index, db_conn, backbone, version)
+
+
+def main():
+    # Only the command line needs the backbone registry, so the functions above work without TensorFlow
+    import image_processor
+
+    parser = argparse.ArgumentParser(description="Export and import gallery index snapshots")
+    parser.add_argument('--db', default='image_features2.db')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = subparsers.add_parser('export', help="Write a snapshot of the current gallery index")
+    export_parser.add_argument('output_dir')
+    export_parser.add_argument('--backbone', choices=list(image_processor.BACKBONES),
+                               help="Embedding model to export, defaults to the one most of the gallery uses")
+
+    import_parser = subparsers.add_parser('import', help="Load a snapshot and apply the changes made since")
+    import_parser.add_argument('snapshot_dir')
+    import_parser.add_argument('--skip-verify', action='store_true', help="Do not check the file checksums")
+
+    prune_parser = subparsers.add_parser('prune', help="Forget deletions older than the oldest snapshot still in use")
+    prune_parser.add_argument('snapshot_dirs', nargs='+', help="Every snapshot that may still be imported")
+
+    args = parser.parse_args()
+    db_conn = database.connect_db(args.db)
+    try:
+        database.create_gallery_table(db_conn)
+        if args.command == 'export':
+            if args.backbone:
+                backbone, version = args.backbone, image_processor.backbone_version(args.backbone)
+            else:
+                backbone, version = image_processor.select_gallery_backbone(db_conn)
+            export_snapshot(db_conn, args.output_dir, backbone, version)
+        elif args.command == 'prune':
+            oldest_generation = min(read_manifest(snapshot_dir)['generation'] for snapshot_dir in args.snapshot_dirs)
+            database.prune_gallery_deletions(db_conn, oldest_generation)
+        else:
+            backbone, version = image_processor.select_gallery_backbone(db_conn)
+            gallery_index = import_snapshot(args.snapshot_dir, db_conn, backbone, version, not args.skip_verify)
+            print(f"Gallery index has {len(gallery_index['ids'])} images at generation {gallery_index['generation']}")
+    finally:
+        db_conn.close()
+
+
+if __name__ == '__main__':
+    main()
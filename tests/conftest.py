@@ -0,0 +1,25 @@
+import json
+import os
+import sys
+
+import pytest
+
+# The modules live at the repository root rather than in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+
+
+@pytest.fixture
+def db_conn(tmp_path):
+    conn = database.connect_db(str(tmp_path / 'gallery.db'))
+    database.create_gallery_table(conn)
+    yield conn
+    conn.close()
+
+
+def add_image(conn, name, features, backbone='vgg16', version='1'):
+    """Insert a gallery image and return its id"""
+    database.insert_gallery_image_with_features(conn, name, f'{name} ingredients', f'images/{name}.jpg',
+                                                json.dumps(features), backbone, version)
+    return conn.execute("SELECT id FROM gallery_table WHERE image_name = ?", (name,)).fetchone()[0]
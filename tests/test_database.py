@@ -0,0 +1,153 @@
+import json
+import sqlite3
+
+import database
+from conftest import add_image
+
+
+def test_legacy_gallery_is_migrated(tmp_path):
+    db_path = str(tmp_path / 'legacy.db')
+    conn = sqlite3.connect(db_path)
+    conn.execute('''CREATE TABLE gallery_table
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT, image_name TEXT, ingredients TEXT,
+                    image_path TEXT, feature_vector TEXT)''')
+    conn.execute("INSERT INTO gallery_table (image_name, image_path, feature_vector) VALUES ('a', 'a.jpg', '[1, 2]')")
+    conn.execute("INSERT INTO gallery_table (image_name, image_path) VALUES ('b', 'b.jpg')")
+    # A tracking trigger as an older version of the module created it
+    conn.execute("CREATE TABLE gallery_meta (key TEXT PRIMARY KEY, value)")
+    conn.execute("INSERT INTO gallery_meta (key, value) VALUES ('generation', 7)")
+    conn.execute('''CREATE TRIGGER gallery_generation_insert AFTER INSERT ON gallery_table
+                    BEGIN UPDATE gallery_meta SET value = value + 1 WHERE key = 'generation'; END''')
+    conn.commit()
+
+    database.create_gallery_table(conn)
+
+    rows = conn.execute("SELECT image_name, backbone, backbone_version, row_generation FROM gallery_table "
+                        "ORDER BY id").fetchall()
+    assert rows == [('a', database.LEGACY_BACKBONE, database.LEGACY_BACKBONE_VERSION, None),
+                    ('b', None, None, None)]
+    assert database.fetch_gallery_generation(conn) == 7
+    assert database.fetch_database_id(conn)
+    triggers = dict(conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger'").fetchall())
+    assert triggers == database.gallery_tracking_triggers()
+    conn.close()
+
+
+def test_tracking_setup_is_idempotent(db_conn):
+    database_id = database.fetch_database_id(db_conn)
+    database.create_gallery_table(db_conn)
+    assert database.fetch_database_id(db_conn) == database_id
+    assert database.fetch_gallery_generation(db_conn) == 0
+
+
+def test_tracking_setup_does_not_need_the_write_lock(tmp_path, db_conn):
+    db_path = str(tmp_path / 'gallery.db')
+    writer = sqlite3.connect(db_path, timeout=0)
+    writer.execute("BEGIN IMMEDIATE")
+    try:
+        other = sqlite3.connect(db_path, timeout=0)
+        database.create_gallery_table(other)
+        assert database.fetch_database_id(other) == database.fetch_database_id(db_conn)
+        other.close()
+    finally:
+        writer.rollback()
+        writer.close()
+
+
+def test_changes_since_a_generation(db_conn):
+    first = add_image(db_conn, 'a', [1.0, 2.0])
+    second = add_image(db_conn, 'b', [3.0, 4.0])
+    generation = database.fetch_gallery_generation(db_conn)
+    assert generation == 2
+
+    database.update_gallery_features(db_conn, [(first, json.dumps([5.0, 6.0]))], 'mobilenet_v2', '1')
+    db_conn.execute("DELETE FROM gallery_table WHERE id = ?", (second,))
+    db_conn.commit()
+    third = add_image(db_conn, 'c', [7.0, 8.0])
+
+    current_generation, changed_rows, deleted_ids = database.fetch_gallery_changes_since(db_conn, generation)
+    assert current_generation == 5
+    assert sorted((row[0], row[4]) for row in changed_rows) == [(first, 'mobilenet_v2'), (third, 'vgg16')]
+    assert deleted_ids == [second]
+
+    assert database.fetch_gallery_changes_since(db_conn, current_generation) == (current_generation, [], [])
+
+
+def test_path_only_changes_are_tracked_but_unchanged_rows_are_not(db_conn):
+    image_id = add_image(db_conn, 'a', [1.0])
+    db_conn.execute("UPDATE gallery_table SET image_path = image_path WHERE id = ?", (image_id,))
+    db_conn.execute("UPDATE gallery_table SET row_generation = 100 WHERE id = ?", (image_id,))
+    db_conn.commit()
+    # The first update touched a data column, the second only row_generation
+    assert database.fetch_gallery_generation(db_conn) == 2
+
+
+def test_pruned_deletions_cannot_be_caught_up_on(db_conn):
+    first = add_image(db_conn, 'a', [1.0])
+    add_image(db_conn, 'b', [2.0])
+    db_conn.execute("DELETE FROM gallery_table WHERE id = ?", (first,))
+    db_conn.commit()
+
+    database.prune_gallery_deletions(db_conn, 3)
+
+    assert db_conn.execute("SELECT COUNT(*) FROM gallery_deletions").fetchone()[0] == 0
+    assert database.fetch_gallery_changes_since(db_conn, 0) is None
+    assert database.fetch_gallery_changes_since(db_conn, 3) == (3, [], [])
+    # Pruning never moves backwards
+    database.prune_gallery_deletions(db_conn, 1)
+    assert database.fetch_gallery_changes_since(db_conn, 2) is None
+
+
+def create_legacy_gallery(db_path):
+    conn = sqlite3.connect(db_path)
+    conn.execute('''CREATE TABLE gallery_table
+                    (id INTEGER PRIMARY KEY AUTOINCREMENT, image_name TEXT, ingredients TEXT,
+                    image_path TEXT, feature_vector TEXT)''')
+    conn.execute("INSERT INTO gallery_table (image_name, image_path, feature_vector) VALUES ('a', 'a.jpg', '[1, 2]')")
+    conn.commit()
+    return conn
+
+
+def test_failed_migration_adds_no_columns(tmp_path):
+    conn = create_legacy_gallery(str(tmp_path / 'legacy.db'))
+    # Make the backfill fail after the columns have been added
+    conn.execute('''CREATE TRIGGER reject_updates BEFORE UPDATE ON gallery_table
+                    BEGIN SELECT RAISE(ABORT, 'rejected'); END''')
+    conn.commit()
+
+    database.add_gallery_columns(conn)
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(gallery_table)")]
+    assert 'backbone' not in columns and 'row_generation' not in columns
+
+    conn.execute("DROP TRIGGER reject_updates")
+    conn.commit()
+    database.add_gallery_columns(conn)
+    assert conn.execute("SELECT backbone FROM gallery_table").fetchall() == [(database.LEGACY_BACKBONE,)]
+    conn.close()
+
+
+def test_migration_waits_for_the_write_lock(tmp_path):
+    db_path = str(tmp_path / 'legacy.db')
+    create_legacy_gallery(db_path).close()
+    writer = sqlite3.connect(db_path, timeout=0)
+    writer.execute("BEGIN IMMEDIATE")
+    conn = sqlite3.connect(db_path, timeout=0)
+    try:
+        database.add_gallery_columns(conn)
+        assert 'backbone' not in [row[1] for row in conn.execute("PRAGMA table_info(gallery_table)")]
+    finally:
+        writer.rollback()
+        writer.close()
+    database.add_gallery_columns(conn)
+    assert conn.execute("SELECT backbone FROM gallery_table").fetchall() == [(database.LEGACY_BACKBONE,)]
+    conn.close()
+
+
+def test_images_to_reembed_skip_rows_without_features(db_conn):
+    old = add_image(db_conn, 'a', [1.0, 2.0])
+    add_image(db_conn, 'b', [3.0], backbone='mobilenet_v2')
+    database.insert_image_with_ingredients(db_conn, 'c', 'c ingredients', 'images/c.jpg')
+
+    rows = database.fetch_gallery_images_not_embedded_with(db_conn, 'mobilenet_v2', '1')
+
+    assert rows == [(old, 'images/a.jpg')]
@@ -0,0 +1,105 @@
+import json
+
+import numpy as np
+
+import database
+import feature_index
+from conftest import add_image
+
+
+def test_load_keeps_only_the_requested_model_and_majority_dimension(db_conn):
+    add_image(db_conn, 'a', [1.0, 2.0])
+    add_image(db_conn, 'b', [3.0, 4.0])
+    add_image(db_conn, 'c', [5.0, 6.0, 7.0])
+    add_image(db_conn, 'd', [8.0, 9.0], backbone='mobilenet_v2')
+
+    gallery_index = feature_index.load_gallery_index(db_conn, 'vgg16', '1')
+
+    assert gallery_index['paths'] == ['images/a.jpg', 'images/b.jpg']
+    assert gallery_index['features'].dtype == np.float32
+    np.testing.assert_array_equal(gallery_index['features'], [[1.0, 2.0], [3.0, 4.0]])
+    assert gallery_index['generation'] == 4
+
+
+def test_empty_gallery_loads_an_empty_matrix(db_conn):
+    gallery_index = feature_index.load_gallery_index(db_conn, 'vgg16', '1')
+    assert gallery_index['features'].shape == (0, 0)
+
+
+def test_apply_gallery_changes(db_conn):
+    first = add_image(db_conn, 'a', [1.0, 2.0])
+    second = add_image(db_conn, 'b', [3.0, 4.0])
+    third = add_image(db_conn, 'c', [5.0, 6.0])
+    gallery_index = feature_index.load_gallery_index(db_conn, 'vgg16', '1')
+
+    database.update_gallery_features(db_conn, [(first, json.dumps([1.5, 2.5]))], 'vgg16', '1')
+    db_conn.execute("DELETE FROM gallery_table WHERE id = ?", (second,))
+    db_conn.commit()
+    fourth = add_image(db_conn, 'd', [7.0, 8.0])
+    # Re-embedded with another model, so it leaves this index
+    database.update_gallery_features(db_conn, [(third, json.dumps([0.0, 0.0, 0.0]))], 'mobilenet_v2', '1')
+
+    updated = feature_index.apply_gallery_changes(gallery_index, db_conn, 'vgg16', '1')
+
+    assert updated['generation'] == database.fetch_gallery_generation(db_conn)
+    rows = dict(zip(updated['ids'], updated['features'].tolist()))
+    assert rows == {first: [1.5, 2.5], fourth: [7.0, 8.0]}
+    assert dict(zip(updated['ids'], updated['paths'])) == {first: 'images/a.jpg', fourth: 'images/d.jpg'}
+    # The original index is left untouched
+    assert gallery_index['ids'] == [first, second, third]
+
+
+def test_unchanged_gallery_returns_the_same_index(db_conn):
+    add_image(db_conn, 'a', [1.0, 2.0])
+    gallery_index = feature_index.load_gallery_index(db_conn, 'vgg16', '1')
+    assert feature_index.apply_gallery_changes(gallery_index, db_conn, 'vgg16', '1') is gallery_index
+
+
+def test_model_switch_loads_the_index_in_full(db_conn):
+    first = add_image(db_conn, 'a', [1.0, 2.0])
+    add_image(db_conn, 'b', [3.0, 4.0])
+    gallery_index = feature_index.load_gallery_index(db_conn, 'vgg16', '1')
+    database.update_gallery_features(db_conn, [(first, json.dumps([9.0, 9.0, 9.0]))], 'mobilenet_v2', '1')
+
+    updated = feature_index.apply_gallery_changes(gallery_index, db_conn, 'mobilenet_v2', '1')
+
+    assert updated['backbone'] == 'mobilenet_v2'
+    assert updated['ids'] == [first]
+    assert updated['features'].shape == (1, 3)
+
+
+def test_pruned_changes_load_the_index_in_full(db_conn):
+    first = add_image(db_conn, 'a', [1.0, 2.0])
+    add_image(db_conn, 'b', [3.0, 4.0])
+    gallery_index = feature_index.load_gallery_index(db_conn, 'vgg16', '1')
+    db_conn.execute("DELETE FROM gallery_table WHERE id = ?", (first,))
+    db_conn.commit()
+    database.prune_gallery_deletions(db_conn, database.fetch_gallery_generation(db_conn))
+
+    updated = feature_index.apply_gallery_changes(gallery_index, db_conn, 'vgg16', '1')
+
+    assert updated['paths'] == ['images/b.jpg']
+
+
+def test_changes_outside_the_index_leave_its_rows_alone(db_conn):
+    add_image(db_conn, 'a', [1.0, 2.0])
+    gallery_index = feature_index.load_gallery_index(db_conn, 'vgg16', '1')
+    # An upload without features and an image embedded with another backbone
+    database.insert_image_with_ingredients(db_conn, 'b', 'b ingredients', 'images/b.jpg')
+    add_image(db_conn, 'c', [3.0, 4.0, 5.0], backbone='mobilenet_v2')
+
+    updated = feature_index.apply_gallery_changes(gallery_index, db_conn, 'vgg16', '1')
+
+    assert updated['generation'] > gallery_index['generation']
+    assert feature_index.same_index_rows(updated, gallery_index)
+    assert feature_index.same_index_rows(feature_index.load_gallery_index(db_conn, 'vgg16', '1'), gallery_index)
+
+
+def test_changed_rows_are_detected(db_conn):
+    first = add_image(db_conn, 'a', [1.0, 2.0])
+    gallery_index = feature_index.load_gallery_index(db_conn, 'vgg16', '1')
+    database.update_gallery_features(db_conn, [(first, json.dumps([1.0, 3.0]))], 'vgg16', '1')
+
+    updated = feature_index.apply_gallery_changes(gallery_index, db_conn, 'vgg16', '1')
+
+    assert not feature_index.same_index_rows(updated, gallery_index)
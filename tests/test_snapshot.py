@@ -0,0 +1,119 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+import database
+import snapshot
+from conftest import add_image
+
+
+def test_round_trip_then_incremental_apply(tmp_path, db_conn):
+    first = add_image(db_conn, 'a', [1.0, 2.0])
+    second = add_image(db_conn, 'b', [3.0, 4.0])
+    snapshot_dir = str(tmp_path / 'snapshot')
+    manifest = snapshot.export_snapshot(db_conn, snapshot_dir, 'vgg16', '1')
+    assert manifest['rows'] == 2
+    assert manifest['database_id'] == database.fetch_database_id(db_conn)
+    assert not os.path.exists(snapshot_dir + '.partial')
+
+    _, loaded = snapshot.load_snapshot(snapshot_dir)
+    assert isinstance(loaded['features'], np.memmap)
+    np.testing.assert_array_equal(loaded['features'], [[1.0, 2.0], [3.0, 4.0]])
+    assert loaded['ids'] == [first, second]
+
+    # Nothing changed since the export, so the memory-mapped matrix is used as is
+    imported = snapshot.import_snapshot(snapshot_dir, db_conn, 'vgg16', '1')
+    assert isinstance(imported['features'], np.memmap)
+
+    db_conn.execute("DELETE FROM gallery_table WHERE id = ?", (first,))
+    db_conn.commit()
+    third = add_image(db_conn, 'c', [5.0, 6.0])
+
+    imported = snapshot.import_snapshot(snapshot_dir, db_conn, 'vgg16', '1')
+    assert imported['generation'] == database.fetch_gallery_generation(db_conn)
+    assert imported['ids'] == [second, third]
+    np.testing.assert_array_equal(imported['features'], [[3.0, 4.0], [5.0, 6.0]])
+
+
+def test_export_refuses_to_overwrite(tmp_path, db_conn):
+    add_image(db_conn, 'a', [1.0, 2.0])
+    snapshot_dir = str(tmp_path / 'snapshot')
+    snapshot.export_snapshot(db_conn, snapshot_dir, 'vgg16', '1')
+    with pytest.raises(FileExistsError):
+        snapshot.export_snapshot(db_conn, snapshot_dir, 'vgg16', '1')
+
+
+def test_corrupted_snapshot_is_rejected(tmp_path, db_conn):
+    add_image(db_conn, 'a', [1.0, 2.0])
+    snapshot_dir = str(tmp_path / 'snapshot')
+    snapshot.export_snapshot(db_conn, snapshot_dir, 'vgg16', '1')
+
+    metadata_path = os.path.join(snapshot_dir, snapshot.METADATA_FILE)
+    with open(metadata_path, 'r+b') as f:
+        data = f.read()
+        f.seek(0)
+        f.write(data.replace(b'images/a.jpg', b'images/z.jpg'))
+
+    with pytest.raises(ValueError):
+        snapshot.load_snapshot(snapshot_dir)
+    # Without verification only the sizes are checked
+    snapshot.load_snapshot(snapshot_dir, verify=False)
+
+
+def test_snapshot_from_another_database_is_rejected(tmp_path, db_conn):
+    add_image(db_conn, 'a', [1.0, 2.0])
+    snapshot_dir = str(tmp_path / 'snapshot')
+    snapshot.export_snapshot(db_conn, snapshot_dir, 'vgg16', '1')
+
+    other_conn = database.connect_db(str(tmp_path / 'other.db'))
+    database.create_gallery_table(other_conn)
+    try:
+        with pytest.raises(ValueError):
+            snapshot.import_snapshot(snapshot_dir, other_conn, 'vgg16', '1')
+    finally:
+        other_conn.close()
+
+
+def test_older_database_loads_the_index_in_full(tmp_path, db_conn):
+    add_image(db_conn, 'a', [1.0, 2.0])
+    add_image(db_conn, 'b', [3.0, 4.0])
+    snapshot_dir = str(tmp_path / 'snapshot')
+    snapshot.export_snapshot(db_conn, snapshot_dir, 'vgg16', '1')
+
+    # As if the database had been restored from a backup taken before the export
+    manifest_path = os.path.join(snapshot_dir, snapshot.MANIFEST_FILE)
+    with open(manifest_path, encoding='utf-8') as f:
+        manifest = json.load(f)
+    manifest['generation'] += 10
+    with open(manifest_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+
+    imported = snapshot.import_snapshot(snapshot_dir, db_conn, 'vgg16', '1')
+    assert imported['generation'] == database.fetch_gallery_generation(db_conn)
+    assert not isinstance(imported['features'], np.memmap)
+
+
+def test_export_to_a_path_with_a_trailing_slash(tmp_path, db_conn):
+    add_image(db_conn, 'a', [1.0, 2.0])
+    snapshot_dir = str(tmp_path / 'snapshot') + os.sep
+    snapshot.export_snapshot(db_conn, snapshot_dir, 'vgg16', '1')
+    assert sorted(os.listdir(tmp_path)) == ['gallery.db', 'snapshot']
+    assert sorted(os.listdir(snapshot_dir)) == sorted([snapshot.FEATURES_FILE, snapshot.METADATA_FILE,
+                                                       snapshot.MANIFEST_FILE])
+
+
+def test_failed_export_leaves_nothing_behind(tmp_path, db_conn, monkeypatch):
+    add_image(db_conn, 'a', [1.0, 2.0])
+    snapshot_dir = str(tmp_path / 'snapshot')
+
+    def fail(path):
+        raise OSError("disk full")
+    monkeypatch.setattr(snapshot, 'file_checksum', fail)
+    with pytest.raises(OSError):
+        snapshot.export_snapshot(db_conn, snapshot_dir, 'vgg16', '1')
+    assert sorted(os.listdir(tmp_path)) == ['gallery.db']
+
+    monkeypatch.undo()
+    snapshot.export_snapshot(db_conn, snapshot_dir, 'vgg16', '1')